@@ -4,13 +4,21 @@ from fastapi.staticfiles import StaticFiles
 import uvicorn
 import asyncio
 import os
-import json
+import time
 import logging
+import orjson
 import websockets  # For exceptions
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 from fastapi import WebSocket, WebSocketDisconnect, HTTPException
-from fastapi.responses import FileResponse, HTMLResponse, JSONResponse
-from typing import Dict, Any, Optional, Set
+from fastapi.responses import FileResponse, HTMLResponse, ORJSONResponse
+from typing import Dict, Any, Optional, Set, Tuple
+from presence_format import format_presence, offline_presence_cache, presence_signature
+
+try:
+    import uvloop  # libuv-based event loop, not available on Windows
+except ImportError:
+    uvloop = None
 
 load_dotenv()  # Load environment variables from .env file
 
@@ -35,333 +43,366 @@ intents = discord.Intents.default()
 intents.presences = True  # Enable Presence Intent
 intents.members = True  # Enable Server Members Intent
 
-client = discord.Client(intents=intents)
+# Only cache members through join/chunking; presence updates are discarded for
+# members that aren't cached, so chunking at startup has to stay enabled.
+member_cache_flags = discord.MemberCacheFlags(voice=False, joined=True)
+
+client = discord.AutoShardedClient(
+    intents=intents, member_cache_flags=member_cache_flags
+)
 
 # --- Shared State ---
 # Dictionary mapping WebSocket connection to a set of subscribed user IDs
 websocket_subscriptions: Dict[WebSocket, Set[int]] = {}
-# Dictionary to store user presence data {user_id: presence_dict}
-user_presences: Dict[int, Dict[str, Any]] = {}
-# Lock for concurrent access to shared state
+# Inverted index mapping user ID to the set of WebSockets subscribed to it
+user_subscribers: Dict[int, Set[WebSocket]] = {}
+# Dictionary to store user presence data {user_id: (presence_dict, presence_json)}
+# presence_json is the serialized dict, reused for every broadcast and INIT_STATE
+user_presences: Dict[int, Tuple[Dict[str, Any], str]] = {}
+# Lock for multi-step read-modify-write of the subscription state.
+# Single-key dict reads/writes are atomic on the event loop and skip it.
 state_lock = asyncio.Lock()
 
-# --- FastAPI Setup ---
-app = fastapi.FastAPI()
+# Member lookup across all guilds {user_id: member}, kept current by member events
+member_index: Dict[int, discord.Member] = {}
+# Members with presence changes waiting for the next flush {user_id: member}
+pending_updates: Dict[int, discord.Member] = {}
+PRESENCE_FLUSH_INTERVAL_S = 0.05  # Debounce window for coalescing presence updates
+# In-flight publish task per user {user_id: task}, at most one at a time
+publishing_tasks: Dict[int, asyncio.Task] = {}
+# Strong references to fire-and-forget tasks so they aren't garbage collected
+background_tasks: Set[asyncio.Task] = set()
+# Monotonic time of the last message received on each WebSocket
+last_seen: Dict[WebSocket, float] = {}
 
-# --- Helper Functions ---
+# --- FastAPI Setup ---
 
 
-def format_activity(activity: discord.Activity) -> Optional[Dict[str, Any]]:
-    """Formats a Discord activity object into a serializable dictionary."""
-    if not activity:
-        return None
-
-    # Basic info common to most activities
-    activity_dict = {
-        "type": activity.type.value,  # Integer type code
-        "name": activity.name,
-    }
-    timestamps = {}  # Initialize timestamp dict
-
-    # --- Safely Process Timestamps ---
-    # Check if start/end attributes EXIST before accessing
-    if hasattr(activity, "start") and activity.start:
-        timestamps["start"] = int(activity.start.timestamp() * 1000)  # Milliseconds
-    if hasattr(activity, "end") and activity.end:
-        timestamps["end"] = int(activity.end.timestamp() * 1000)  # Milliseconds
-
-    # --- Add type-specific details ---
-    if isinstance(activity, discord.Game):  # Type 0 - Playing
-        # Timestamps handled above if they existed
-        if hasattr(activity, "details") and activity.details:
-            activity_dict["details"] = activity.details
-        if hasattr(activity, "state") and activity.state:
-            activity_dict["state"] = activity.state
-    elif isinstance(activity, discord.Streaming):  # Type 1 - Streaming
-        activity_dict.update(
-            {
-                "url": activity.url,
-                "details": activity.details,
-                "state": activity.state,
-            }
-        )
-    elif isinstance(activity, discord.Spotify):  # Type 2 - Listening to Spotify
-        # Spotify always has start/end, handled by hasattr check above
-        assets = {}
-        if activity.album_cover_url:
-            assets["large_image"] = activity.album_cover_url
-            assets["large_text"] = activity.album
-        activity_dict.update(
-            {
-                "type": 2,  # Ensure type is Listening
-                "details": activity.title,
-                "state": "; ".join(activity.artists),
-                "assets": assets,
-                "album": activity.album,
-                "party": {"id": activity.party_id} if activity.party_id else None,
-                "sync_id": activity.track_id,  # Lanyard uses sync_id for track_id
-            }
-        )
-        activity_dict["name"] = "Spotify"  # Lanyard standard
-    elif (
-        isinstance(activity, discord.Activity)
-        and activity.type == discord.ActivityType.watching
-    ):  # Type 3 - Watching
-        # Generic activities might have start/end, handled above
-        if hasattr(activity, "details") and activity.details:
-            activity_dict["details"] = activity.details
-        if hasattr(activity, "state") and activity.state:
-            activity_dict["state"] = activity.state
-    elif isinstance(activity, discord.CustomActivity):  # Type 4 - Custom Status
-        # Custom activities DO NOT have start/end
-        activity_dict.update(
-            {
-                "state": activity.state,
-                "emoji": {
-                    "name": activity.emoji.name,
-                    "id": str(activity.emoji.id) if activity.emoji.id else None,
-                    "animated": activity.emoji.animated,
-                }
-                if activity.emoji
-                else None,
-            }
-        )
-        timestamps = {}  # Ensure timestamps are empty for custom status
-    elif (
-        isinstance(activity, discord.Activity)
-        and activity.type == discord.ActivityType.competing
-    ):  # Type 5 - Competing
-        # Competing might have start/end?
-        if hasattr(activity, "details") and activity.details:
-            activity_dict["details"] = activity.details
-        if hasattr(activity, "state") and activity.state:
-            activity_dict["state"] = activity.state
-
-    # --- Add common optional fields AFTER type-specific processing ---
-    if timestamps:  # Add timestamps dict if it has entries
-        activity_dict["timestamps"] = timestamps
-
-    # Add generic details/state if present and not already handled by specific type
-    # (Check again to catch types not explicitly listed, e.g. generic Activity)
-    if (
-        hasattr(activity, "details")
-        and activity.details
-        and "details" not in activity_dict
-    ):
-        activity_dict["details"] = activity.details
-    if hasattr(activity, "state") and activity.state and "state" not in activity_dict:
-        # Check if state is already set (e.g. by CustomActivity) to avoid overwriting
-        pass  # activity_dict["state"] = activity.state
-
-    # Assets (common for games/rich presence) - Check existence before adding
-    assets_dict = {}
-    if hasattr(activity, "large_image_url") and activity.large_image_url:
-        assets_dict["large_image"] = (
-            activity.large_image_url
-        )  # Using URL for simplicity
-        if hasattr(activity, "large_image_text") and activity.large_image_text:
-            assets_dict["large_text"] = activity.large_image_text
-    if hasattr(activity, "small_image_url") and activity.small_image_url:
-        assets_dict["small_image"] = activity.small_image_url
-        if hasattr(activity, "small_image_text") and activity.small_image_text:
-            assets_dict["small_text"] = activity.small_image_text
-    if assets_dict:  # Only add 'assets' key if we found any
-        activity_dict["assets"] = assets_dict
-
-    # Party info
-    if (
-        hasattr(activity, "party")
-        and activity.party
-        and isinstance(activity.party, dict)
-    ):
-        party_data = {}
-        if "id" in activity.party:
-            party_data["id"] = activity.party["id"]
-        if "size" in activity.party:
-            party_data["size"] = activity.party["size"]
-        if party_data:
-            activity_dict["party"] = party_data
-
-    if (
-        hasattr(activity, "flags") and activity.flags is not None
-    ):  # Check flags exist and aren't None
-        # Check if flags is the Enum object or already an int
-        if isinstance(activity.flags, int):
-            activity_dict["flags"] = activity.flags  # Use the int directly
-        elif hasattr(
-            activity.flags, "value"
-        ):  # Check if it has a .value attribute (like an Enum)
-            activity_dict["flags"] = activity.flags.value  # Get the integer value
-        else:
-            # Log unexpected type if necessary
-            logger.warning(
-                f"Unexpected type for activity.flags: {type(activity.flags)}, value: {activity.flags}"
-            )
-    return activity_dict
-
-
-def format_presence(
-    member: Optional[discord.Member], fallback_user: Optional[discord.User] = None
-) -> Dict[str, Any]:
-    """Formats a Discord Member object's presence into a Lanyard-like dictionary."""
-
-    user_obj = (
-        member if member else fallback_user
-    )  # Prioritize member object for user info if available
-
-    # Construct offline state if member is None or status is offline
-    # Use the member's status directly
-    if not member or member.status == discord.Status.offline:
-        # Ensure we use the user_obj determined above for details
-        return {
-            "discord_user": {
-                "id": str(user_obj.id) if user_obj else "unknown",
-                "username": user_obj.name if user_obj else "unknown",
-                "discriminator": user_obj.discriminator if user_obj else "0000",
-                "avatar": user_obj.avatar.url if user_obj and user_obj.avatar else None,
-                "bot": user_obj.bot if user_obj else False,
-                "public_flags": user_obj.public_flags.value if user_obj else 0,
-            },
-            "discord_status": "offline",
-            "activities": [],
-            "client_status": {},
-            "active_on_discord_mobile": False,
-            "active_on_discord_desktop": False,
-            "active_on_discord_web": False,
-            "spotify": None,
-        }
-
-    # Format online presence using the Member object directly
-    # user_obj is guaranteed to be the 'member' here since member is not None
-    formatted = {
-        "discord_user": {
-            "id": str(member.id),
-            "username": member.name,
-            "discriminator": member.discriminator,
-            "avatar": member.avatar.url if member.avatar else None,
-            "bot": member.bot,
-            "public_flags": member.public_flags.value,
-        },
-        "discord_status": str(member.status),  # Access status directly
-        "activities": [
-            act_data for act in member.activities if (act_data := format_activity(act))
-        ],  # Access activities directly
-        "client_status": {  # Access client statuses directly
-            "desktop": str(member.desktop_status) != "offline",
-            "mobile": str(member.mobile_status) != "offline",
-            "web": str(member.web_status) != "offline",
-        },
-        "active_on_discord_mobile": str(member.mobile_status) != "offline",
-        "active_on_discord_desktop": str(member.desktop_status) != "offline",
-        "active_on_discord_web": str(member.web_status) != "offline",
-    }
-
-    # Extract Spotify info if present and format it specifically for the 'spotify' key
-    # Access activities directly from the member
-    spotify_activity = next(
-        (act for act in member.activities if isinstance(act, discord.Spotify)), None
+@asynccontextmanager
+async def lifespan(app: fastapi.FastAPI):
+    """Runs the background tasks for the lifetime of the web server."""
+    sweeper_task = asyncio.create_task(
+        heartbeat_sweeper(), name="HeartbeatSweeperTask"
     )
-    formatted["spotify"] = (
-        format_activity(spotify_activity) if spotify_activity else None
+    flusher_task = asyncio.create_task(
+        presence_flusher(), name="PresenceFlusherTask"
     )
+    try:
+        yield
+    finally:
+        sweeper_task.cancel()
+        flusher_task.cancel()
+
+
+app = fastapi.FastAPI(lifespan=lifespan)
+
+# --- Helper Functions ---
+
+
+def unsubscribe_websocket(websocket: WebSocket, user_ids: Set[int]):
+    """Removes a WebSocket from the subscriber index for the given user IDs.
+
+    Drops the cached presence of users left without subscribers.
+    Caller must hold state_lock.
+    """
+    for user_id in user_ids:
+        subscribers = user_subscribers.get(user_id)
+        if subscribers is None:
+            continue
+        subscribers.discard(websocket)
+        if not subscribers:
+            del user_subscribers[user_id]
+            # Unwatched users aren't refreshed, so don't keep serving their cache
+            user_presences.pop(user_id, None)
+
+
+def remove_websocket(websocket: WebSocket) -> bool:
+    """Drops a WebSocket from all subscription state. Caller must hold state_lock."""
+    subscribed_ids = websocket_subscriptions.pop(websocket, None)
+    if subscribed_ids is None:
+        return False
+    unsubscribe_websocket(websocket, subscribed_ids)
+    return True
+
+
+async def close_quietly(websocket: WebSocket, code: int):
+    """Closes a WebSocket, ignoring errors from an already-dead connection."""
+    try:
+        await websocket.close(code=code)
+    except Exception:
+        pass
+
+
+def spawn_background(coro) -> asyncio.Task:
+    """Runs a coroutine as a task and keeps a reference until it finishes."""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+async def send_orjson(websocket: WebSocket, message: Any):
+    """Serializes a message with orjson and sends it as a text frame.
+
+    Text frames are kept because the web client parses ``event.data`` as a
+    string; the server still UTF-8 encodes each frame per client.
+    """
+    await websocket.send_text(orjson.dumps(message).decode())
 
-    return formatted
 
+def build_event_message(event_type: str, presence_json: str) -> str:
+    """Wraps already-serialized presence data in an OP_EVENT message."""
+    return f'{{"op":{OP_EVENT},"t":"{event_type}","d":{presence_json}}}'
 
-async def notify_subscribed_clients(user_id: int, presence_data: Dict[str, Any]):
+
+async def notify_subscribed_clients(user_id: int, presence_json: str):
     """Sends presence update to clients subscribed to this user_id."""
-    if not presence_data:
-        logger.warning(f"Attempted to notify with invalid presence data for {user_id}")
+    if not presence_json:
+        logger.warning("Attempted to notify with invalid presence data for %s", user_id)
         return
 
-    message_payload = {
-        "op": OP_EVENT,  # Event OP Code
-        "t": "PRESENCE_UPDATE",  # Event Type
-        "d": presence_data,  # Event Data
-    }
-    message_str = json.dumps(message_payload)
-    logger.debug(f"Broadcasting presence update for user {user_id}")
+    message_str = build_event_message("PRESENCE_UPDATE", presence_json)
+    logger.debug("Broadcasting presence update for user %s", user_id)
 
     disconnected_clients = []
-    # Iterate safely over a copy of items
-    # Lock needed here if another task could modify the dict during iteration
-    async with state_lock:
-        subscriptions_copy = list(websocket_subscriptions.items())
+    # Snapshot only this user's subscribers; the set may change while we send
+    targets = list(user_subscribers.get(user_id, ()))
+
+    # Send concurrently so one slow client doesn't hold up the rest
+    results = await asyncio.gather(
+        *(
+            asyncio.wait_for(
+                websocket.send_text(message_str), timeout=SEND_TIMEOUT_S
+            )
+            for websocket in targets
+        ),
+        return_exceptions=True,
+    )
 
-    for websocket, subscribed_ids in subscriptions_copy:
-        if user_id in subscribed_ids:
-            try:
-                await websocket.send_text(message_str)
-                # logger.debug(f"Sent presence update for {user_id} to {websocket.client}")
-            except (
+    for websocket, result in zip(targets, results):
+        if not isinstance(result, BaseException):
+            continue
+        if isinstance(
+            result,
+            (
                 WebSocketDisconnect,
                 websockets.exceptions.ConnectionClosedOK,
                 websockets.exceptions.ConnectionClosedError,
-            ):
-                logger.info(
-                    f"Client {websocket.client} disconnected during broadcast for user {user_id}."
-                )
-                disconnected_clients.append(websocket)
-            except Exception as e:
-                logger.error(
-                    f"Error sending message to WebSocket {websocket.client} for user {user_id}: {e}"
-                )
-                disconnected_clients.append(
-                    websocket
-                )  # Assume dead on other errors too
+            ),
+        ):
+            logger.info(
+                "Client %s disconnected during broadcast for user %s.",
+                websocket.client,
+                user_id,
+            )
+        elif isinstance(result, asyncio.TimeoutError):
+            logger.warning(
+                "Send to %s for user %s timed out after %ss, evicting.",
+                websocket.client,
+                user_id,
+                SEND_TIMEOUT_S,
+            )
+        else:
+            logger.error(
+                "Error sending message to WebSocket %s for user %s: %s",
+                websocket.client,
+                user_id,
+                result,
+            )
+        disconnected_clients.append(websocket)  # Assume dead on any failure
 
     # Clean up disconnected clients
     if disconnected_clients:
         async with state_lock:
             for client_ws in disconnected_clients:
-                if client_ws in websocket_subscriptions:
-                    del websocket_subscriptions[client_ws]
+                if remove_websocket(client_ws):
                     logger.info(
-                        f"Removed disconnected client {client_ws.client} from subscriptions. Count: {len(websocket_subscriptions)}"
+                        "Removed disconnected client %s from subscriptions. Count: %s",
+                        client_ws.client,
+                        len(websocket_subscriptions),
                     )
+        # Close evicted sockets so the endpoint loop exits and the client
+        # reconnects; done in tasks so a stuck close can't stall the broadcast
+        for client_ws in disconnected_clients:
+            spawn_background(close_quietly(client_ws, 1011))
 
 
 async def update_presence_state(user_id: int, presence_data: Dict[str, Any]):
     """Updates the shared presence dictionary and notifies relevant websockets."""
-    async with state_lock:
-        if not presence_data:
-            logger.warning(
-                f"Received invalid presence data for {user_id}, not updating state."
+    if not presence_data:
+        logger.warning(
+            "Received invalid presence data for %s, not updating state.", user_id
+        )
+        return
+
+    # Serialize once; broadcasts and INIT_STATE reuse the cached string
+    presence_json = orjson.dumps(presence_data).decode()
+    user_presences[user_id] = (presence_data, presence_json)
+    logger.debug("Updated presence cache for user %s", user_id)
+
+    # Awaited directly; the flusher already runs off the gateway's path
+    await notify_subscribed_clients(user_id, presence_json)
+
+
+async def publish_presence(user_id: int, member: discord.Member):
+    """Formats a member's current presence and broadcasts it."""
+    try:
+        await update_presence_state(user_id, format_presence(member))
+    except Exception as e:
+        logger.error(
+            "Error processing presence update for %s: %s", user_id, e, exc_info=True
+        )
+
+
+async def presence_flusher():
+    """Publishes pending presence updates once per PRESENCE_FLUSH_INTERVAL_S.
+
+    Bursts of updates for the same user (e.g. Spotify track skips) collapse
+    into a single format and broadcast of the member's latest state. Each user
+    publishes in its own task so a backpressured client can't stall the flush;
+    a user whose previous publish is still sending stays pending until it
+    finishes, which keeps that user's updates in order.
+    """
+    while True:
+        await asyncio.sleep(PRESENCE_FLUSH_INTERVAL_S)
+        for user_id in list(pending_updates):
+            if user_id in publishing_tasks:
+                continue  # Retry on a later flush with whatever is newest then
+            member = pending_updates.pop(user_id)
+            task = asyncio.create_task(publish_presence(user_id, member))
+            publishing_tasks[user_id] = task
+            task.add_done_callback(
+                lambda _task, user_id=user_id: publishing_tasks.pop(user_id, None)
             )
-            return
 
-        user_presences[user_id] = presence_data
-        logger.debug(f"Updated presence cache for user {user_id}")
 
-    # Notify outside the lock to avoid holding it during network I/O
-    asyncio.create_task(notify_subscribed_clients(user_id, presence_data))
+def index_guild_members(guild: discord.Guild):
+    """Adds every cached member of a guild to member_index."""
+    for member in guild.members:
+        member_index[member.id] = member
+
+
+def find_member(user_id: int) -> Optional[discord.Member]:
+    """Returns the live cached Member for a user, repairing member_index if needed.
+
+    discord.py builds new Member objects when a guild becomes available again or
+    is re-chunked, and late chunks fire no event, so an indexed member may be
+    orphaned or missing. Both cases fall back to scanning the guilds.
+    """
+    member = member_index.get(user_id)
+    if member is not None:
+        guild = client.get_guild(member.guild.id)
+        if guild and guild.get_member(user_id) is member:
+            return member
+
+    for guild in client.guilds:
+        member = guild.get_member(user_id)
+        if member:
+            member_index[user_id] = member
+            return member
+    member_index.pop(user_id, None)
+    return None
+
+
+def unindex_member(user_id: int, left_guild: discord.Guild):
+    """Drops a user from member_index, falling back to another guild they share."""
+    for guild in client.guilds:
+        if guild.id == left_guild.id:
+            continue
+        member = guild.get_member(user_id)
+        if member:
+            member_index[user_id] = member
+            return
+    member_index.pop(user_id, None)
 
 
 # --- Discord Event Handlers ---
 @client.event
 async def on_ready():
     logger.info(f"Logged in as {client.user.name} ({client.user.id})")
+    for guild in client.guilds:
+        index_guild_members(guild)
+    logger.info(f"Indexed {len(member_index)} members.")
     logger.info("Bot is ready and listening for presence updates.")
 
 
+@client.event
+async def on_guild_join(guild: discord.Guild):
+    index_guild_members(guild)
+
+
+@client.event
+async def on_guild_available(guild: discord.Guild):
+    # Fired when a guild comes back after an outage with freshly built members
+    index_guild_members(guild)
+
+
+@client.event
+async def on_guild_remove(guild: discord.Guild):
+    for member in guild.members:
+        if member_index.get(member.id) is member:
+            unindex_member(member.id, guild)
+
+
+@client.event
+async def on_member_join(member: discord.Member):
+    member_index[member.id] = member
+
+
+@client.event
+async def on_member_remove(member: discord.Member):
+    if member_index.get(member.id) is member:
+        unindex_member(member.id, member.guild)
+
+
+@client.event
+async def on_member_update(before: discord.Member, after: discord.Member):
+    member_index[after.id] = after  # 'after' is the live cached member
+
+
+@client.event
+async def on_user_update(before: discord.User, after: discord.User):
+    """Called when a user's name, avatar or flags change."""
+    offline_presence_cache.pop(after.id, None)
+
+    # The presence_update that follows shares this User object between its
+    # before/after members, so it compares equal and is dropped as a no-op.
+    # Republish here so the new name/avatar reaches the cache and subscribers.
+    member = find_member(after.id)
+    if member and user_subscribers.get(after.id):
+        pending_updates[after.id] = member
+    else:
+        user_presences.pop(after.id, None)
+
+
 @client.event
 async def on_presence_update(before: discord.Member, after: discord.Member):
     """Called when a member's presence changes."""
     if after.bot:  # Ignore bots
         return
 
+    member_index[after.id] = after  # 'after' is the live cached member
+
+    # Drop no-op updates for users we've already cached
+    if after.id in user_presences and presence_signature(
+        before
+    ) == presence_signature(after):
+        return
+
+    offline_presence_cache.pop(after.id, None)
+
+    # Nobody is listening: skip formatting and drop any stale cache entry.
+    # REST and INIT_STATE format uncached users from the live Member instead.
+    if not user_subscribers.get(after.id):
+        user_presences.pop(after.id, None)
+        return
+
     logger.debug(
-        f"Presence update for: {after.name} ({after.id}) Status: {after.status}"
+        "Presence update for: %s (%s) Status: %s", after.name, after.id, after.status
     )
-    try:
-        # Pass both presence and user for robust formatting
-        presence_data = format_presence(after)
-        # Update state and notify websockets
-        await update_presence_state(after.id, presence_data)
-    except Exception as e:
-        logger.error(
-            f"Error processing presence update for {after.id}: {e}", exc_info=True
-        )
+    # Queue for the flusher; 'after' is the live cached member, so the latest
+    # state wins when several updates land within one debounce window
+    pending_updates[after.id] = after
 
 
 # --- FastAPI Endpoints ---
@@ -381,36 +422,31 @@ async def get_user_presence(user_id_str: str):
     except ValueError:
         raise HTTPException(status_code=400, detail="User ID must be an integer.")
 
-    async with state_lock:
-        presence_data_cached = user_presences.get(user_id)
+    cached_presence = user_presences.get(user_id)
 
-    if presence_data_cached:
-        return JSONResponse(content={"success": True, "data": presence_data_cached})
+    if cached_presence:
+        presence_data_cached, _ = cached_presence
+        return ORJSONResponse(content={"success": True, "data": presence_data_cached})
     else:
-        # User presence not cached, try to find user/member and return offline state
-        member_obj: Optional[discord.Member] = None
+        # User presence not cached, format it from the live member (or offline from the user)
+        member_obj: Optional[discord.Member] = find_member(user_id)
         user_obj: Optional[discord.User] = client.get_user(user_id)
 
-        # Try finding Member object across guilds
-        for guild in client.guilds:
-            member_candidate = guild.get_member(user_id)
-            if member_candidate:
-                member_obj = member_candidate  # Found a member object
-                break  # Found one, no need to check other guilds
-
         # Prioritize member_obj if found, otherwise use user_obj if found
         user_for_offline = member_obj if member_obj else user_obj
 
         if user_for_offline:  # If we found any representation of the user
             logger.debug(
-                f"User {user_id} not in presence cache, returning offline state using {type(user_for_offline).__name__} object."
+                "User %s not in presence cache, formatting from %s object.",
+                user_id,
+                type(user_for_offline).__name__,
             )
             # Call format_presence with the member object (if found, else None)
             # and the user object as the fallback (if member wasn't found but user was)
             offline_data = format_presence(member_obj, user_obj)
-            return JSONResponse(content={"success": True, "data": offline_data})
+            return ORJSONResponse(content={"success": True, "data": offline_data})
         else:
-            logger.warning(f"User {user_id} not found by bot for REST request.")
+            logger.warning("User %s not found by bot for REST request.", user_id)
             raise HTTPException(
                 status_code=404, detail="User not found or bot cannot access user."
             )
@@ -424,6 +460,34 @@ OP_HEARTBEAT = 3  # Client->Server: Heartbeat acknowledgement/keepalive
 
 HEARTBEAT_INTERVAL_S = 30
 CLIENT_TIMEOUT_S = HEARTBEAT_INTERVAL_S + 15
+SEND_TIMEOUT_S = 5  # Max time a single broadcast send may block before eviction
+HEARTBEAT_SWEEP_INTERVAL_S = 5  # How often to check for timed-out clients
+
+# Invariant server messages, serialized once at import
+HELLO_MESSAGE = orjson.dumps(
+    {"op": OP_HELLO, "d": {"heartbeat_interval": HEARTBEAT_INTERVAL_S * 1000}}
+).decode()
+HEARTBEAT_ACK_MESSAGE = orjson.dumps({"op": 11}).decode()
+
+
+async def heartbeat_sweeper():
+    """Closes WebSockets that haven't sent a message within CLIENT_TIMEOUT_S."""
+    while True:
+        await asyncio.sleep(HEARTBEAT_SWEEP_INTERVAL_S)
+        deadline = time.monotonic() - CLIENT_TIMEOUT_S
+        stale = [ws for ws, seen in last_seen.items() if seen < deadline]
+        for websocket in stale:
+            del last_seen[websocket]  # Don't close the same client twice
+            logger.info(
+                "Client %s timed out (no message received in %ss). Closing connection.",
+                websocket.client,
+                CLIENT_TIMEOUT_S,
+            )
+        # Close concurrently; the endpoint's receive loop handles the cleanup
+        await asyncio.gather(
+            *(websocket.close(code=1001) for websocket in stale),
+            return_exceptions=True,
+        )
 
 
 @app.websocket("/ws")
@@ -438,41 +502,37 @@ async def websocket_endpoint(websocket: WebSocket):
     try:
         await websocket.accept()
         connection_active = True
-        logger.info(f"WebSocket client connected: {ws_client_host}")
+        logger.info("WebSocket client connected: %s", ws_client_host)
 
         # Send HELLO message with heartbeat interval
         try:
-            await websocket.send_json(
-                {
-                    "op": OP_HELLO,
-                    "d": {"heartbeat_interval": HEARTBEAT_INTERVAL_S * 1000},
-                }
-            )
+            await websocket.send_text(HELLO_MESSAGE)
         except (WebSocketDisconnect, websockets.exceptions.ConnectionClosed):
             logger.info(
-                f"Client {ws_client_host} disconnected immediately after connect during HELLO."
+                "Client %s disconnected immediately after connect during HELLO.",
+                ws_client_host,
             )
             return  # Exit early
 
         # Add to subscriptions with an empty set
-        async with state_lock:
-            websocket_subscriptions[websocket] = set()
+        websocket_subscriptions[websocket] = set()
+        last_seen[websocket] = time.monotonic()
 
         while True:
             try:
-                # Wait for a message from the client with a timeout
-                raw_data = await asyncio.wait_for(
-                    websocket.receive_text(), timeout=CLIENT_TIMEOUT_S
-                )
+                # Wait for a message; heartbeat_sweeper closes idle clients
+                raw_data = await websocket.receive_text()
+                if websocket in last_seen:
+                    last_seen[websocket] = time.monotonic()
                 try:
-                    data = json.loads(raw_data)
-                except json.JSONDecodeError:
+                    data = orjson.loads(raw_data)
+                except orjson.JSONDecodeError:
                     logger.warning(
-                        f"Received invalid JSON from {ws_client_host}. Ignoring."
+                        "Received invalid JSON from %s. Ignoring.", ws_client_host
                     )
                     continue  # Wait for next message
 
-                logger.debug(f"Received message from {ws_client_host}: {data}")
+                logger.debug("Received message from %s: %s", ws_client_host, data)
 
                 op = data.get("op")
                 payload = data.get("d")
@@ -480,14 +540,16 @@ async def websocket_endpoint(websocket: WebSocket):
                 if op == OP_INITIALIZE:
                     if not isinstance(payload, dict):
                         logger.warning(
-                            f"Invalid payload 'd' for OP {op} from {ws_client_host}"
+                            "Invalid payload 'd' for OP %s from %s", op, ws_client_host
                         )
                         continue
 
                     subscribe_ids_str = payload.get("subscribe_to_ids")
                     if not isinstance(subscribe_ids_str, list):
                         logger.warning(
-                            f"Invalid 'subscribe_to_ids' format from {ws_client_host}: {subscribe_ids_str}"
+                            "Invalid 'subscribe_to_ids' format from %s: %s",
+                            ws_client_host,
+                            subscribe_ids_str,
                         )
                         continue
 
@@ -504,81 +566,83 @@ async def websocket_endpoint(websocket: WebSocket):
                                 newly_subscribed_ids.add(user_id_int)
                         except ValueError:
                             logger.warning(
-                                f"Invalid user ID format received from {ws_client_host}: {user_id_str}"
+                                "Invalid user ID format received from %s: %s",
+                                ws_client_host,
+                                user_id_str,
                             )
 
-                    # Update the subscription set for this websocket
+                    # Update the subscription set and the subscriber index for this websocket
                     async with state_lock:
+                        previous_subs = websocket_subscriptions.get(websocket, set())
+                        unsubscribe_websocket(
+                            websocket, previous_subs - valid_ids_to_subscribe
+                        )
+                        for user_id_int in valid_ids_to_subscribe - previous_subs:
+                            user_subscribers.setdefault(user_id_int, set()).add(
+                                websocket
+                            )
                         websocket_subscriptions[websocket] = valid_ids_to_subscribe
                     logger.info(
-                        f"Client {ws_client_host} updated subscriptions to IDs: {valid_ids_to_subscribe}"
+                        "Client %s updated subscriptions to IDs: %s",
+                        ws_client_host,
+                        valid_ids_to_subscribe,
                     )
 
                     # Send initial state for newly subscribed IDs
                     if newly_subscribed_ids:
                         logger.info(
-                            f"Sending initial presence for {newly_subscribed_ids} to {ws_client_host}"
+                            "Sending initial presence for %s to %s",
+                            newly_subscribed_ids,
+                            ws_client_host,
                         )
                         initial_states_to_send = []
-                        async with (
-                            state_lock
-                        ):  # Need lock to safely read user_presences
-                            for sub_id in newly_subscribed_ids:
-                                cached_presence_dict = user_presences.get(sub_id)
-                                state_to_send = None
-
-                                if cached_presence_dict:
-                                    # Use the cached presence dictionary directly
-                                    state_to_send = cached_presence_dict
-                                    logger.debug(
-                                        f"Using cached presence for {sub_id} for INIT_STATE"
-                                    )
-                                else:
-                                    # Not cached, generate offline state by finding user/member
-                                    logger.debug(
-                                        f"Generating offline state for {sub_id} for INIT_STATE"
-                                    )
-                                    member_obj: Optional[discord.Member] = None
-                                    user_obj: Optional[discord.User] = client.get_user(
-                                        sub_id
-                                    )
-
-                                    # Try finding Member object across guilds if necessary
-                                    if not user_obj or not isinstance(
-                                        user_obj, discord.Member
-                                    ):
-                                        for guild in client.guilds:
-                                            member_candidate = guild.get_member(sub_id)
-                                            if member_candidate:
-                                                member_obj = (
-                                                    member_candidate  # Found member
-                                                )
-                                                user_obj = member_obj  # Use member as the primary user obj for fallback
-                                                break
-                                    elif isinstance(user_obj, discord.Member):
-                                        # User found via get_user was already a Member object
-                                        member_obj = user_obj
-
-                                    # Call format_presence ONLY to generate offline state
-                                    # Pass member_obj (which might be None) and user_obj (best available user info)
-                                    state_to_send = format_presence(
-                                        member_obj, user_obj
-                                    )
-                                initial_states_to_send.append(
-                                    {
-                                        "op": OP_EVENT,
-                                        "t": "INIT_STATE",
-                                        "d": state_to_send,  # Use the dictionary determined above
-                                    }
+                        for sub_id in newly_subscribed_ids:
+                            cached_presence = user_presences.get(sub_id)
+                            state_json = None
+
+                            if cached_presence:
+                                # Reuse the cached serialized presence directly
+                                _, state_json = cached_presence
+                                logger.debug(
+                                    "Using cached presence for %s for INIT_STATE",
+                                    sub_id,
+                                )
+                            else:
+                                # Not cached, generate offline state by finding user/member
+                                logger.debug(
+                                    "Generating offline state for %s for INIT_STATE",
+                                    sub_id,
+                                )
+                                member_obj: Optional[discord.Member] = find_member(
+                                    sub_id
+                                )
+                                # Use member as the primary user obj for fallback
+                                user_obj: Optional[discord.User] = (
+                                    member_obj or client.get_user(sub_id)
                                 )
 
+                                # Call format_presence ONLY to generate offline state
+                                # Pass member_obj (which might be None) and user_obj (best available user info)
+                                state_json = orjson.dumps(
+                                    format_presence(member_obj, user_obj)
+                                ).decode()
+                            initial_states_to_send.append(
+                                (
+                                    sub_id,
+                                    build_event_message("INIT_STATE", state_json),
+                                )
+                            )
+
                         # Send all initial states found
-                        for state_msg in initial_states_to_send:
+                        for sub_id, state_msg in initial_states_to_send:
                             try:
-                                await websocket.send_json(state_msg)
+                                await websocket.send_text(state_msg)
                             except Exception as e:
                                 logger.error(
-                                    f"Failed to send initial state to {ws_client_host} for user {state_msg['d']['discord_user']['id']}: {e}"
+                                    "Failed to send initial state to %s for user %s: %s",
+                                    ws_client_host,
+                                    sub_id,
+                                    e,
                                 )
                                 # If sending fails, the connection might be dead, break loop?
                                 raise websockets.exceptions.ConnectionClosed(
@@ -588,27 +652,26 @@ async def websocket_endpoint(websocket: WebSocket):
                 elif op == OP_HEARTBEAT:
                     # Client acknowledged heartbeat or is sending keepalive
                     # Receiving any message within the timeout resets it implicitly
-                    logger.debug(f"Received heartbeat from {ws_client_host}")
+                    logger.debug("Received heartbeat from %s", ws_client_host)
 
                     try:
-                        await websocket.send_json({"op": 11})
+                        await websocket.send_text(HEARTBEAT_ACK_MESSAGE)
                     except Exception:
-                        logger.warning(f"Failed to send Heartbeat ACK to {ws_client_host}")
+                        logger.warning(
+                            "Failed to send Heartbeat ACK to %s", ws_client_host
+                        )
 
                 else:
                     logger.warning(
-                        f"Received unknown OP code {op} from {ws_client_host}"
+                        "Received unknown OP code %s from %s", op, ws_client_host
                     )
                     try:
-                        await websocket.send_json({"op": -1, "d": f"Unknown OP Code: {op}"})
+                        await send_orjson(
+                            websocket, {"op": -1, "d": f"Unknown OP Code: {op}"}
+                        )
                     except Exception: 
                         pass
 
-            except asyncio.TimeoutError:
-                logger.info(
-                    f"Client {ws_client_host} timed out (no message received in {CLIENT_TIMEOUT_S}s). Closing connection."
-                )
-                break
             except (
                 WebSocketDisconnect,
                 websockets.exceptions.ConnectionClosedOK,
@@ -617,12 +680,17 @@ async def websocket_endpoint(websocket: WebSocket):
                 code = e.code if hasattr(e, "code") else "N/A"
                 reason = e.reason if hasattr(e, "reason") else "N/A"
                 logger.info(
-                    f"WebSocket client {ws_client_host} disconnected. Code: {code}, Reason: {reason}"
+                    "WebSocket client %s disconnected. Code: %s, Reason: %s",
+                    ws_client_host,
+                    code,
+                    reason,
                 )
                 break  # Exit the loop
             except Exception as e:
                 logger.error(
-                    f"Unexpected WebSocket error for {ws_client_host}: {e}",
+                    "Unexpected WebSocket error for %s: %s",
+                    ws_client_host,
+                    e,
                     exc_info=True,
                 )
                 # Break loop on unexpected errors to ensure cleanup
@@ -631,14 +699,16 @@ async def websocket_endpoint(websocket: WebSocket):
     except Exception as e:
         # Catch errors during the initial accept or HELLO phase
         logger.error(
-            f"Error during WebSocket setup or outer loop for {ws_client_host}: {e}",
+            "Error during WebSocket setup or outer loop for %s: %s",
+            ws_client_host,
+            e,
             exc_info=True,
         )
     finally:
         # Ensure removal from subscriptions on disconnect/error/timeout
         async with state_lock:
-            if websocket in websocket_subscriptions:
-                del websocket_subscriptions[websocket]
+            remove_websocket(websocket)
+        last_seen.pop(websocket, None)
         # Ensure websocket is closed if the loop was exited due to error rather than clean disconnect
         if (
             connection_active
@@ -651,7 +721,9 @@ async def websocket_endpoint(websocket: WebSocket):
             except Exception:
                 pass  # Ignore errors during close, already handling exit
         logger.info(
-            f"WebSocket connection closed for {ws_client_host}. Active connections: {len(websocket_subscriptions)}"
+            "WebSocket connection closed for %s. Active connections: %s",
+            ws_client_host,
+            len(websocket_subscriptions),
         )
 
 
@@ -672,7 +744,16 @@ async def run_bot():
 
 async def run_server():
     """Starts the FastAPI server."""
-    config = uvicorn.Config(app, host=HOST, port=PORT, log_level="info")
+    config = uvicorn.Config(
+        app,
+        host=HOST,
+        port=PORT,
+        http="httptools",
+        ws="websockets",
+        # Presence payloads are small; deflate costs more CPU than it saves
+        ws_per_message_deflate=False,
+        log_level="info",
+    )
     server = uvicorn.Server(config)
     try:
         await server.serve()
@@ -728,7 +809,12 @@ async def main():
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        # The server runs inside our loop, so uvloop has to be installed here
+        # rather than via uvicorn's loop setting.
+        if uvloop:
+            uvloop.run(main())
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         logger.info("Shutdown requested by user (KeyboardInterrupt).")
     except Exception as e:
@@ -0,0 +1,340 @@
+"""Discord presence formatting, kept separate from main.py so it can be compiled.
+
+Everything here is fully annotated plain Python. Running ``mypyc presence_format.py``
+builds a native extension that ``import presence_format`` picks up ahead of this
+source file; without it the module runs interpreted as usual.
+"""
+
+import discord
+from collections import OrderedDict
+from discord.activity import ActivityTypes
+from typing import Dict, Any, Optional, Callable
+
+# --- Caches ---
+# Bounded LRU of formatted activity dicts, keyed by activity_cache_key()
+ACTIVITY_CACHE_SIZE = 4096
+activity_cache: "OrderedDict[tuple, Dict[str, Any]]" = OrderedDict()
+# Offline presence dicts by user ID, invalidated on presence/user updates
+offline_presence_cache: Dict[int, Dict[str, Any]] = {}
+
+# --- Formatting ---
+# Each concrete activity class gets its own cache key builder and formatter, so
+# attributes are read directly instead of probed with hasattr().
+
+
+def format_timestamps(activity: Any) -> Dict[str, int]:
+    """Converts an activity's start/end datetimes to millisecond timestamps."""
+    timestamps = {}
+    if activity.start:
+        timestamps["start"] = int(activity.start.timestamp() * 1000)  # Milliseconds
+    if activity.end:
+        timestamps["end"] = int(activity.end.timestamp() * 1000)  # Milliseconds
+    return timestamps
+
+
+def game_cache_key(activity: discord.Game) -> tuple:
+    return (discord.Game, activity.name, activity.start, activity.end)
+
+
+def format_game(activity: discord.Game) -> Dict[str, Any]:
+    """Type 0 - Playing (slimmed down Game object)."""
+    activity_dict: Dict[str, Any] = {
+        "type": activity.type.value,
+        "name": activity.name,
+    }
+    timestamps = format_timestamps(activity)
+    if timestamps:
+        activity_dict["timestamps"] = timestamps
+    return activity_dict
+
+
+def streaming_cache_key(activity: discord.Streaming) -> tuple:
+    return (
+        discord.Streaming,
+        activity.name,
+        activity.url,
+        activity.details,
+        activity.game,
+    )
+
+
+def format_streaming(activity: discord.Streaming) -> Dict[str, Any]:
+    """Type 1 - Streaming. Streaming has no timestamps or image assets."""
+    return {
+        "type": activity.type.value,
+        "name": activity.name,
+        "url": activity.url,
+        "details": activity.details,
+        "state": activity.game,  # discord.py exposes the activity state as 'game'
+    }
+
+
+def spotify_cache_key(activity: discord.Spotify) -> tuple:
+    return (
+        discord.Spotify,
+        activity.title,
+        tuple(activity.artists),
+        activity.album,
+        activity.album_cover_url,
+        activity.track_id,
+        activity.party_id,
+        activity.start,
+        activity.end,
+    )
+
+
+def format_spotify(activity: discord.Spotify) -> Dict[str, Any]:
+    """Type 2 - Listening to Spotify, in Lanyard's format."""
+    assets = {}
+    if activity.album_cover_url:
+        assets["large_image"] = activity.album_cover_url
+        assets["large_text"] = activity.album
+    activity_dict: Dict[str, Any] = {
+        "type": 2,  # Ensure type is Listening
+        "name": "Spotify",  # Lanyard standard
+        "details": activity.title,
+        "state": "; ".join(activity.artists),
+        "assets": assets,
+        "album": activity.album,
+        "party": {"id": activity.party_id} if activity.party_id else None,
+        "sync_id": activity.track_id,  # Lanyard uses sync_id for track_id
+    }
+    # Spotify always has start/end
+    timestamps = format_timestamps(activity)
+    if timestamps:
+        activity_dict["timestamps"] = timestamps
+    return activity_dict
+
+
+def custom_activity_cache_key(activity: discord.CustomActivity) -> tuple:
+    emoji = activity.emoji
+    return (
+        discord.CustomActivity,
+        activity.name,
+        activity.state,
+        (emoji.name, emoji.id, emoji.animated) if emoji else None,
+    )
+
+
+def format_custom_activity(activity: discord.CustomActivity) -> Dict[str, Any]:
+    """Type 4 - Custom Status. Custom activities DO NOT have start/end."""
+    return {
+        "type": activity.type.value,
+        "name": activity.name,
+        "state": activity.state,
+        "emoji": {
+            "name": activity.emoji.name,
+            "id": str(activity.emoji.id) if activity.emoji.id else None,
+            "animated": activity.emoji.animated,
+        }
+        if activity.emoji
+        else None,
+    }
+
+
+def generic_activity_cache_key(activity: discord.Activity) -> tuple:
+    party = activity.party
+    return (
+        discord.Activity,
+        activity.type,
+        activity.name,
+        activity.details,
+        activity.state,
+        activity.start,
+        activity.end,
+        activity.large_image_url,
+        activity.large_image_text,
+        activity.small_image_url,
+        activity.small_image_text,
+        (party.get("id"), tuple(party.get("size") or ())) if party else None,
+        activity.flags,
+    )
+
+
+def format_generic_activity(activity: discord.Activity) -> Dict[str, Any]:
+    """Full rich presence Activity (playing, listening, watching, competing...)."""
+    activity_dict: Dict[str, Any] = {
+        "type": activity.type.value,  # Integer type code
+        "name": activity.name,
+    }
+
+    # Watching (3) and Competing (5) expose both details and state
+    if activity.type in (discord.ActivityType.watching, discord.ActivityType.competing):
+        if activity.details:
+            activity_dict["details"] = activity.details
+        if activity.state:
+            activity_dict["state"] = activity.state
+
+    timestamps = format_timestamps(activity)
+    if timestamps:
+        activity_dict["timestamps"] = timestamps
+
+    # Other types only carry details
+    if activity.details and "details" not in activity_dict:
+        activity_dict["details"] = activity.details
+
+    # Assets (common for games/rich presence)
+    assets_dict = {}
+    if activity.large_image_url:
+        assets_dict["large_image"] = activity.large_image_url  # Using URL for simplicity
+        if activity.large_image_text:
+            assets_dict["large_text"] = activity.large_image_text
+    if activity.small_image_url:
+        assets_dict["small_image"] = activity.small_image_url
+        if activity.small_image_text:
+            assets_dict["small_text"] = activity.small_image_text
+    if assets_dict:  # Only add 'assets' key if we found any
+        activity_dict["assets"] = assets_dict
+
+    # Party info
+    if activity.party:
+        party_data: Dict[str, Any] = {}
+        if "id" in activity.party:
+            party_data["id"] = activity.party["id"]
+        if "size" in activity.party:
+            party_data["size"] = activity.party["size"]
+        if party_data:
+            activity_dict["party"] = party_data
+
+    activity_dict["flags"] = activity.flags  # Always an int on Activity
+    return activity_dict
+
+
+# Dispatch tables keyed by the concrete activity class.
+# Anything not listed is a full discord.Activity.
+ACTIVITY_CACHE_KEYS: Dict[type, Callable[[Any], tuple]] = {
+    discord.Game: game_cache_key,
+    discord.Streaming: streaming_cache_key,
+    discord.Spotify: spotify_cache_key,
+    discord.CustomActivity: custom_activity_cache_key,
+}
+ACTIVITY_FORMATTERS: Dict[type, Callable[[Any], Dict[str, Any]]] = {
+    discord.Game: format_game,
+    discord.Streaming: format_streaming,
+    discord.Spotify: format_spotify,
+    discord.CustomActivity: format_custom_activity,
+}
+
+
+def activity_cache_key(activity: ActivityTypes) -> tuple:
+    """Builds a hashable key from every attribute format_activity reads."""
+    return ACTIVITY_CACHE_KEYS.get(type(activity), generic_activity_cache_key)(
+        activity
+    )
+
+
+def format_activity(activity: Optional[ActivityTypes]) -> Optional[Dict[str, Any]]:
+    """Formats a Discord activity object into a serializable dictionary.
+
+    Results are memoized in activity_cache; callers must not mutate them.
+    """
+    if not activity:
+        return None
+
+    cache_key = activity_cache_key(activity)
+    cached = activity_cache.get(cache_key)
+    if cached is not None:
+        activity_cache.move_to_end(cache_key)
+        return cached
+
+    activity_dict = ACTIVITY_FORMATTERS.get(type(activity), format_generic_activity)(
+        activity
+    )
+
+    activity_cache[cache_key] = activity_dict
+    if len(activity_cache) > ACTIVITY_CACHE_SIZE:
+        activity_cache.popitem(last=False)  # Evict least recently used
+    return activity_dict
+
+
+def presence_signature(member: discord.Member) -> tuple:
+    """Builds a hashable summary of everything format_presence emits for a member."""
+    return (
+        member.status,
+        member.desktop_status,
+        member.mobile_status,
+        member.web_status,
+        tuple(activity_cache_key(act) for act in member.activities),
+    )
+
+
+def format_presence(
+    member: Optional[discord.Member], fallback_user: Optional[discord.User] = None
+) -> Dict[str, Any]:
+    """Formats a Discord Member object's presence into a Lanyard-like dictionary."""
+
+    user_obj = (
+        member if member else fallback_user
+    )  # Prioritize member object for user info if available
+
+    # Construct offline state if member is None or status is offline
+    # Use the member's status directly
+    if not member or member.status == discord.Status.offline:
+        # Offline state only depends on user details, so reuse it until they change
+        if user_obj:
+            cached_offline = offline_presence_cache.get(user_obj.id)
+            if cached_offline is not None:
+                return cached_offline
+
+        # Ensure we use the user_obj determined above for details
+        offline = {
+            "discord_user": {
+                "id": str(user_obj.id) if user_obj else "unknown",
+                "username": user_obj.name if user_obj else "unknown",
+                "discriminator": user_obj.discriminator if user_obj else "0000",
+                "avatar": user_obj.avatar.url if user_obj and user_obj.avatar else None,
+                "bot": user_obj.bot if user_obj else False,
+                "public_flags": user_obj.public_flags.value if user_obj else 0,
+            },
+            "discord_status": "offline",
+            "activities": [],
+            "client_status": {},
+            "active_on_discord_mobile": False,
+            "active_on_discord_desktop": False,
+            "active_on_discord_web": False,
+            "spotify": None,
+        }
+        if user_obj:
+            offline_presence_cache[user_obj.id] = offline
+        return offline
+
+    # Format online presence using the Member object directly
+    # user_obj is guaranteed to be the 'member' here since member is not None
+    # Compare platform statuses by identity instead of going through str(Enum)
+    offline_status = discord.Status.offline
+    desktop_on = member.desktop_status is not offline_status
+    mobile_on = member.mobile_status is not offline_status
+    web_on = member.web_status is not offline_status
+    formatted = {
+        "discord_user": {
+            "id": str(member.id),
+            "username": member.name,
+            "discriminator": member.discriminator,
+            "avatar": member.avatar.url if member.avatar else None,
+            "bot": member.bot,
+            "public_flags": member.public_flags.value,
+        },
+        "discord_status": member.status.value,  # Same as str(member.status)
+        "activities": [
+            act_data for act in member.activities if (act_data := format_activity(act))
+        ],  # Access activities directly
+        "client_status": {  # Access client statuses directly
+            "desktop": desktop_on,
+            "mobile": mobile_on,
+            "web": web_on,
+        },
+        "active_on_discord_mobile": mobile_on,
+        "active_on_discord_desktop": desktop_on,
+        "active_on_discord_web": web_on,
+    }
+
+    # Extract Spotify info if present and format it specifically for the 'spotify' key
+    # Access activities directly from the member
+    spotify_activity = next(
+        (act for act in member.activities if isinstance(act, discord.Spotify)), None
+    )
+    formatted["spotify"] = (
+        format_activity(spotify_activity) if spotify_activity else None
+    )
+
+    return formatted